@@ -1,8 +1,62 @@
-import psycopg2
-import psycopg2.extras
-from psycopg2.sql import SQL, Identifier
-from psycopg2.extras import DictCursor
-from math import log2
+import atexit
+import bisect
+import math
+import re
+import threading
+import weakref
+from collections import OrderedDict
+
+# psycopg2 (and orjson) are imported on first database use, so importing this
+# module for node_registry or the node classes alone does not load the driver
+_json_loads_registered = False
+
+def _register_json_loads():
+    # Decode json/jsonb with orjson when it is installed (optional, faster on big plans)
+    global _json_loads_registered
+    if _json_loads_registered:
+        return
+    _json_loads_registered = True
+    try:
+        import orjson
+    except ImportError:
+        return
+    import psycopg2.extras
+    psycopg2.extras.register_default_json(globally=True, loads=orjson.loads)
+    psycopg2.extras.register_default_jsonb(globally=True, loads=orjson.loads)
+
+# Connection pools, one per set of connection parameters, kept alive across queries
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(dbname, user, password, host, port):
+    key = (dbname, user, password, host, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            from psycopg2.pool import ThreadedConnectionPool
+            pool = ThreadedConnectionPool(
+                minconn=1,
+                maxconn=16,
+                dbname=dbname,
+                user=user,
+                password=password,
+                host=host,
+                port=port,
+            )
+            _pools[key] = pool
+        return pool
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+atexit.register(close_pools)
+
+# Connections whose last analysis failed with a driver error. analyze_query reports errors as
+# strings instead of raising, so it records the connection here for DBConnection to discard
+_broken_conns = weakref.WeakSet()
 
 # Database connection management
 class DBConnection:
@@ -13,23 +67,75 @@ class DBConnection:
         self.host = host
         self.port = port
         self.conn = None
+        self.pool = None
 
     def __enter__(self):
-        self.conn = psycopg2.connect(
-            dbname=self.dbname,
-            user=self.user,
-            password=self.password,
-            host=self.host,
-            port=self.port,
-        )
+        # Check out a pooled connection instead of opening a new one per query
+        self.pool = get_pool(self.dbname, self.user, self.password, self.host, self.port)
+        self.conn = self.pool.getconn()
         return self.conn
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        import psycopg2
+        # A connection that hit a database error (raised here or reported by analyze_query) or was dropped
+        # is closed rather than reused, together with its prepared statements.
+        # Otherwise putconn() rolls back any open transaction, so no session state leaks to the next caller
+        broken = (self.conn.closed or self.conn in _broken_conns
+                  or (exc_type is not None and issubclass(exc_type, psycopg2.Error)))
+        _broken_conns.discard(self.conn)
+        self.pool.putconn(self.conn, close=bool(broken))
+        self.conn = None
+
+# Catalog queries are PREPAREd once per connection; pooled connections keep them across analyses
+_CATALOG_STATEMENTS = {
+    'relation_stats': """
+        SELECT relname, reltuples, relpages
+        FROM pg_class
+        WHERE relname = ANY($1)
+    """,
+    'index_columns': """
+        SELECT pg_class.relname, attname
+        FROM pg_index
+        JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+        JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND pg_attribute.attnum = ANY(pg_index.indkey)
+        WHERE pg_class.relname = ANY($1)
+    """,
+    'column_stats': """
+        SELECT tablename, attname, n_distinct, null_frac, histogram_bounds::text
+        FROM pg_stats
+        WHERE tablename = ANY($1)
+    """,
+    'primary_keys': """
+        SELECT pg_class.relname, attname
+        FROM pg_index
+        JOIN pg_class ON pg_class.oid = pg_index.indrelid
+        JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND pg_attribute.attnum = pg_index.indkey[0]
+        WHERE pg_index.indisprimary AND pg_index.indnatts = 1 AND pg_class.relname = ANY($1)
+    """,
+}
+# Names already PREPAREd on each connection. Each name is recorded as soon as its PREPARE succeeds
+# (prepared statements outlive a rollback), so an interrupted loop resumes instead of re-preparing
+_prepared_conns = weakref.WeakKeyDictionary()
+
+def prepare_catalog_statements(cursor):
+    conn = cursor.connection
+    prepared = _prepared_conns.setdefault(conn, set())
+    if len(prepared) == len(_CATALOG_STATEMENTS):
+        return
+    for name, query in _CATALOG_STATEMENTS.items():
+        if name not in prepared:
+            cursor.execute(f"PREPARE {name}(name[]) AS {query}")
+            prepared.add(name)
 
 # Node registration system
 node_registry = {}
 
+# Indent strings for the common plan depths, built once
+_INDENTS = tuple('    ' * i for i in range(64))
+
+def _indent(depth):
+    return _INDENTS[depth] if depth < len(_INDENTS) else '    ' * depth
+
 def register_node(node_type):
     def decorator(cls):
         node_registry[node_type] = cls
@@ -38,50 +144,86 @@ def register_node(node_type):
 
 # Base Node class
 class Node:
-    def __init__(self, node_json, cursor):
+    __slots__ = ('node_json', 'cursor', 'children', 'stats_cache')
+
+    def __init__(self, node_json, cursor, stats_cache=None):
         self.node_json = node_json
         self.cursor = cursor
         self.children = []
-
-    def fetch_stats(self):
+        # Catalog rows shared by every node of one analysis, keyed by (catalog, name)
+        self.stats_cache = stats_cache if stats_cache is not None else {}
+
+    def fetch_relation_stats(self, rel_name):
+        key = ('pg_class', rel_name)
+        if key not in self.stats_cache:
+            prepare_catalog_statements(self.cursor)
+            self.cursor.execute("EXECUTE relation_stats(%s)", ([rel_name],))
+            row = self.cursor.fetchone()
+            self.stats_cache[key] = row[1:] if row else None  # (reltuples, relpages)
+        return self.stats_cache[key]
+
+    def fetch_column_stats(self, rel_name):
+        # Planner statistics for every column of the relation, as {attname: (n_distinct, null_frac, histogram_bounds)}
+        key = ('pg_stats', rel_name)
+        if key not in self.stats_cache:
+            prepare_catalog_statements(self.cursor)
+            self.cursor.execute("EXECUTE column_stats(%s)", ([rel_name],))
+            columns = {}
+            for row in self.cursor.fetchall():
+                columns.setdefault(row[1], row[2:])
+            self.stats_cache[key] = columns
+        return self.stats_cache[key]
+
+    def fetch_primary_key(self, rel_name):
+        # Column of a single-column primary key, None for composite or missing keys
+        key = ('pg_index_pk', rel_name)
+        if key not in self.stats_cache:
+            prepare_catalog_statements(self.cursor)
+            self.cursor.execute("EXECUTE primary_keys(%s)", ([rel_name],))
+            row = self.cursor.fetchone()
+            self.stats_cache[key] = row[1] if row else None
+        return self.stats_cache[key]
+
+    def fetch_stats(self, depth, out):
         # This method will be overridden in child classes if needed.
-        return ""
-
-    def explain(self, depth=0):
-        indent = '    ' * depth
-        explanation = f"{indent}Node Type: {self.node_json.get('Node Type', 'Unknown')}\n"
-        explanation += f"{indent}Estimated Cost: Startup {self.node_json.get('Startup Cost')},Total {self.node_json.get('Total Cost')}\n"
-        explanation += self.fetch_stats(depth)
-        for child in self.children:
-            explanation += child.explain(depth + 1)
-        return explanation
-    
-    def fetch_stats(self, depth):
-        return ""
+        pass
+
+# First predicate of a Filter/Index Cond: "((c.c_acctbal)::numeric > '100'::numeric)" -> ('c_acctbal', '>', "'100'::numeric")
+_COND_RE = re.compile(
+    r"\(*(?:\w+\.)*(?P<attr>\w+)\)*(?:::\w+)?\s*"
+    r"(?P<op>IS\s+NOT\s+NULL|IS\s+NULL|<>|!=|<=|>=|<|>|=|!?~~\*?)\s*(?P<val>.*)",
+    re.IGNORECASE,
+)
+
+# Fallback selectivity of range operators when the column has no usable histogram
+_RANGE_SEL_DEFAULTS = {'<': 1 / 3, '<=': 1 / 3, '>': 1 / 3, '>=': 1 / 3}
+
+# Operators estimated as the complement of their positive form (<> of =, NOT LIKE / NOT ILIKE of LIKE / ILIKE)
+_NEGATED_OPS = frozenset(('<>', '!=', '!~~', '!~~*'))
 
 class ScanNodes(Node):
+    __slots__ = ()
 
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        stats_info = super().fetch_stats(depth)  # Call to base class fetch_stats if needed
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
+        super().fetch_stats(depth, out)  # Call to base class fetch_stats if needed
 
         num_tuples = self.cardinality(True)
         num_blocks = self.cardinality(False)
         
         # Building stats information string
-        stats_info += f"{indent}Estimated Tuples: {num_tuples}, Estimated Blocks: {num_blocks}\n"
-        stats_info += f"{indent}Filter/Condition: {self.node_json.get('Filter', self.node_json.get('Index Cond', 'None'))}\n"
-        return stats_info
+        out.append(f"{indent}Estimated Tuples: {num_tuples}, Estimated Blocks: {num_blocks}\n")
+        out.append(f"{indent}Filter/Condition: {self.node_json.get('Filter', self.node_json.get('Index Cond', 'None'))}\n")
 
     def cardinality(self, is_tuple):
-        rel = self.node_json.get("Relation Name", "unknown")
-        self.cursor.execute("SELECT reltuples, relpages FROM pg_class WHERE relname = %s", (rel,))
-        stats = self.cursor.fetchone()
+        rel = self.node_json.get("Relation Name")
+        if not rel:
+            return 0  # Joins, hashes, etc. have no base relation
+        stats = self.fetch_relation_stats(rel)
         if not stats:
             return 0
 
-        num_blocks = stats['relpages']
-        num_tuples = stats['reltuples']
+        num_tuples, num_blocks = stats
 
         if "Filter" not in self.node_json and "Index Cond" not in self.node_json:
             return num_tuples if is_tuple else num_blocks
@@ -97,57 +239,126 @@ class ScanNodes(Node):
         else:
             return 1  # No condition selectivity = 1
 
-        attr = self.retrieve_attribute_from_condition()
-        op = self.retrieve_operator_from_condition()
+        attr, op, value = self.parse_condition()
+        if op is None:
+            return 1  # Boolean columns, function calls etc. are not estimated
+        rel = self.node_json.get("Relation Name")
+        column_stats = self.fetch_column_stats(rel).get(attr) if rel else None
+
+        if op.startswith("IS"):
+            # IS [NOT] NULL: the null fraction pg_stats keeps for the column
+            null_frac = column_stats[1] if column_stats and column_stats[1] is not None else 0
+            return 1 - null_frac if "NOT" in op else null_frac
+
+        default = _RANGE_SEL_DEFAULTS.get(op)
+        if default is not None:
+            # Range predicate: interpolate in the pg_stats histogram when there is one, else the default
+            selectivity = self.histogram_selectivity(column_stats, op, self.literal_value(value))
+            return selectivity if selectivity is not None else default
+
+        if rel and attr == self.fetch_primary_key(rel):
+            # Every primary key value is distinct, so V(R, a) is simply T(R)
+            stats = self.fetch_relation_stats(rel)
+            num_unique = stats[0] if stats else 0
+        else:
+            num_unique = self.fetch_unique_values(rel, attr, conditions) if rel else 0
 
-        num_unique = 0
+        if num_unique <= 0:
+            return 0  # Unknown; reltuples is -1 for tables never vacuumed or analyzed (PG14+)
+        # col IN (...) is planned as "= ANY ('{a,b,c}'...)": one match per listed value
+        num_values = value.count(",") + 1 if value.upper().startswith("ANY") else 1
+        selectivity = min(1, num_values / num_unique)
+        return 1 - selectivity if op in _NEGATED_OPS else selectivity
 
-        if ">" in op or "<" in op:
-            return 1 / 3
-        elif num_unique == 0:
+    def fetch_unique_values(self, table_name, column_name, condition):
+        # V(R, a) from pg_stats instead of scanning the table with COUNT(DISTINCT)
+        column_stats = self.fetch_column_stats(table_name).get(column_name)
+        if not column_stats or column_stats[0] is None:
             return 0
+        n_distinct = column_stats[0]
+        if n_distinct < 0:
+            # Negative values are a fraction of the row count
+            stats = self.fetch_relation_stats(table_name)
+            return -n_distinct * stats[0] if stats else 0
+        return n_distinct
+
+    @staticmethod
+    def histogram_selectivity(column_stats, op, value):
+        # Fraction of rows on the requested side of value, from the equi-depth histogram
+        if not column_stats or not column_stats[2] or op not in _RANGE_SEL_DEFAULTS:
+            return None
+        try:
+            value = float(value)
+            bounds = [float(bound) for bound in column_stats[2].strip('{}').split(',')]
+        except (TypeError, ValueError):
+            return None  # Non-numeric column or literal
+        if len(bounds) < 2 or not math.isfinite(value) or not all(math.isfinite(bound) for bound in bounds):
+            return None  # NaN/Infinity literals or bounds can't be placed in a bucket
+
+        if value <= bounds[0]:
+            fraction_below = 0.0
+        elif value >= bounds[-1]:
+            fraction_below = 1.0
         else:
-            return 1 / num_unique
-
-    def retrieve_attribute_from_condition(self):
-        condition = self.node_json.get("Filter") or self.node_json.get("Index Cond")
-        if condition:
-            return condition.split()[0].strip("()").split(".")[-1]
-        return None
-
-    def retrieve_operator_from_condition(self):
+            bucket = min(bisect.bisect_right(bounds, value), len(bounds) - 1) - 1
+            low, high = bounds[bucket], bounds[bucket + 1]
+            within = (value - low) / (high - low) if high > low else 0.0
+            fraction_below = (bucket + within) / (len(bounds) - 1)
+
+        selectivity = fraction_below if op in ('<', '<=') else 1 - fraction_below
+        null_frac = column_stats[1] or 0
+        return selectivity * (1 - null_frac)
+
+    def join_inputs(self):
+        # Outer and inner child plans, read once; {} when a side is missing
+        plans = self.node_json.get('Plans', ())
+        left_child = plans[0] if len(plans) > 0 else {}
+        right_child = plans[1] if len(plans) > 1 else {}
+        return left_child, right_child
+
+    def parse_condition(self):
+        # (attribute, operator, right-hand side) of the first predicate; (None, None, None) if it can't be parsed
         condition = self.node_json.get("Filter") or self.node_json.get("Index Cond")
-        if condition:
-            return condition.split()[1]
-        return None
+        match = _COND_RE.match(condition) if condition else None
+        if not match:
+            return None, None, None
+        op = " ".join(match.group("op").upper().split())
+        return match.group("attr"), op, match.group("val")
+
+    @staticmethod
+    def literal_value(value):
+        # Literal on the right-hand side, e.g. "'1000'::numeric)" -> "1000"
+        if not value:
+            return None
+        return value.rstrip(")").split("::")[0].strip("'(")
 
 # Specific Node implementations
 @register_node('Seq Scan')
 class SeqScanNode(ScanNodes):  # done
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
+    __slots__ = ()
+
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
         table_name = self.node_json.get('Relation Name')
         if table_name:
-            self.cursor.execute("SELECT reltuples, relpages FROM pg_class WHERE relname = %s", (table_name,))
-            stats = self.cursor.fetchone()
+            stats = self.fetch_relation_stats(table_name)
             if stats:
-                manual_cost = stats['relpages']  
+                manual_cost = stats[1]  # relpages
                 dbms_estimated_cost = self.node_json.get('Total Cost')
 
-                explanation = super().fetch_stats(depth) 
-                explanation += f"{indent}Manual Cost Formula: B(R) = {manual_cost}\n"
-                explanation += f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {dbms_estimated_cost})\n"
+                super().fetch_stats(depth, out)
+                out.append(f"{indent}Manual Cost Formula: B(R) = {manual_cost}\n")
+                out.append(f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {dbms_estimated_cost})\n")
                 
                 if manual_cost != dbms_estimated_cost:
-                    explanation += f"{indent}Difference Explanation: PostgreSQL factors in efficiencies not captured here.\n"
-                
-                return explanation
-        return ""
+                    out.append(f"{indent}Difference Explanation: PostgreSQL factors in efficiencies not captured here.\n")
 
 @register_node('Index Scan')
 class IndexScanNode(ScanNodes):  # done
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
+    __slots__ = ()
+
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
         index_name = self.node_json.get('Index Name')
         table_name = self.node_json.get('Relation Name')
         column_name = self.extract_column_name_from_index(index_name)
@@ -156,8 +367,7 @@ class IndexScanNode(ScanNodes):  # done
             T_R = self.fetch_total_tuples(table_name)
             condition = self.node_json.get('Index Cond', '')
 
-            # if condition is range query
-            if any(op in condition for op in ['<=', '>=', '<', '>']):
+            if self.is_range_condition(condition):
                 V_R_a = 3
             else:
                 V_R_a = self.fetch_unique_values(table_name, column_name, condition)
@@ -168,174 +378,266 @@ class IndexScanNode(ScanNodes):  # done
             manual_cost = T_R / V_R_a
             estimated_cost = self.node_json.get('Total Cost')
 
-            explanation = super().fetch_stats(depth)
-            explanation += f"{indent}Manual Cost Formula: T(R) / V(R, a) = {manual_cost}\n"
-            explanation += f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n"
+            super().fetch_stats(depth, out)
+            out.append(f"{indent}Manual Cost Formula: T(R) / V(R, a) = {manual_cost}\n")
+            out.append(f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n")
 
             if manual_cost != estimated_cost:
-                explanation += f"{indent}Difference Explanation: Factors like index selectivity and disk I/O are optimized by PostgreSQL.\n"
-
-            return explanation
-        return ""
+                out.append(f"{indent}Difference Explanation: Factors like index selectivity and disk I/O are optimized by PostgreSQL.\n")
 
     def fetch_total_tuples(self, table_name):
-        self.cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", (table_name,))
-        result = self.cursor.fetchone()
+        result = self.fetch_relation_stats(table_name)
         return result[0] if result else 0
 
-    def fetch_unique_values(self, table_name, column_name, condition):
-        query = f"SELECT COUNT(DISTINCT {column_name}) FROM {table_name}"
-        self.cursor.execute(query)
-        result = self.cursor.fetchone()
-        return result[0] if result else 0
+    @staticmethod
+    def is_range_condition(condition):
+        return any(op in condition for op in ['<=', '>=', '<', '>'])
 
     def extract_column_name_from_index(self, index_name):
-        self.cursor.execute("""
-            SELECT attname
-            FROM pg_index
-            JOIN pg_class ON pg_class.oid = pg_index.indexrelid
-            JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND pg_attribute.attnum = ANY(pg_index.indkey)
-            WHERE pg_class.relname = %s
-        """, (index_name,))
+        key = ('pg_index', index_name)
+        if key in self.stats_cache:
+            return self.stats_cache[key]
+        prepare_catalog_statements(self.cursor)
+        self.cursor.execute("EXECUTE index_columns(%s)", ([index_name],))
         result = self.cursor.fetchone()
-        return result[0] if result else None
+        self.stats_cache[key] = result[1] if result else None
+        return self.stats_cache[key]
     
 @register_node('Nested Loop Join') # done
 class NestedLoopJoinNode(ScanNodes): 
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
-        left_child = self.node_json.get('Plans', [])[0] if 'Plans' in self.node_json else {}
-        right_child = self.node_json.get('Plans', [])[1] if len(self.node_json.get('Plans', [])) > 1 else {}
+    __slots__ = ()
+
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
+        left_child, right_child = self.join_inputs()
         left_cost = left_child.get('Total Cost', 0)
         right_cost = right_child.get('Total Cost', 0)
         left_rows = left_child.get('Plan Rows', 0)
         manual_cost = left_cost + (left_rows * right_cost)
         estimated_cost = self.node_json.get('Total Cost')
-        explanation = f"{indent}Nested Loop Join uses condition: {self.node_json.get('Join Filter', 'No specific join condition reported')}\n"
-        explanation += f"{indent}Manual Cost Formula: Outer Loop Cost(Total Cost of R) + (Outer Loop Rows(Rows in R) × Inner Loop Cost(Total Cost of S)) = {manual_cost}\n"
-        explanation += f"{indent}Written in simplier terms, Manual Cost Formula: min(B(R), B(S)) + (B(R) * B(S))\n"
-        explanation += f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n"
+        super().fetch_stats(depth, out)
+        out.append(f"{indent}Nested Loop Join uses condition: {self.node_json.get('Join Filter', 'No specific join condition reported')}\n")
+        out.append(f"{indent}Manual Cost Formula: Outer Loop Cost(Total Cost of R) + (Outer Loop Rows(Rows in R) × Inner Loop Cost(Total Cost of S)) = {manual_cost}\n")
+        out.append(f"{indent}Written in simplier terms, Manual Cost Formula: min(B(R), B(S)) + (B(R) * B(S))\n")
+        out.append(f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n")
         if manual_cost != estimated_cost:
-            explanation += f"{indent}Difference Explanation: PostgreSQL may optimize nested loop joins by using indexing on the inner relation or caching the inner relation in memory if it is small enough. These optimizations can significantly reduce the actual cost compared to the manual estimation, especially if the inner relation is accessed multiple times.\n"
-            explanation += f"{indent}PostgreSQL also considers the cost of handling tuples that meet the join condition and may benefit from tuple prefetching and other join algorithms when applicable.\n"
-        return base_stats + explanation
+            out.append(f"{indent}Difference Explanation: PostgreSQL may optimize nested loop joins by using indexing on the inner relation or caching the inner relation in memory if it is small enough. These optimizations can significantly reduce the actual cost compared to the manual estimation, especially if the inner relation is accessed multiple times.\n")
+            out.append(f"{indent}PostgreSQL also considers the cost of handling tuples that meet the join condition and may benefit from tuple prefetching and other join algorithms when applicable.\n")
 
 @register_node('Merge Join') # done
 class MergeJoinNode(ScanNodes):
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
-        left_child = self.node_json.get('Plans', [])[0] if 'Plans' in self.node_json else {}
-        right_child = self.node_json.get('Plans', [])[1] if len(self.node_json.get('Plans', [])) > 1 else {}
+    __slots__ = ()
+
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
+        left_child, right_child = self.join_inputs()
         left_cost = left_child.get('Total Cost', 0)
         right_cost = right_child.get('Total Cost', 0)
         manual_cost = 3 * (left_cost + right_cost)
         estimated_cost = self.node_json.get('Total Cost')
 
-        explanation = f"{indent}Merge Join on keys: {self.node_json.get('Merge Key', 'No merge keys reported')}\n"
-        explanation += f"{indent}Manual Cost Formula: 3(B(R) + B(S)) = {manual_cost}\n"
-        explanation += f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n"
+        super().fetch_stats(depth, out)
+        out.append(f"{indent}Merge Join on keys: {self.node_json.get('Merge Key', 'No merge keys reported')}\n")
+        out.append(f"{indent}Manual Cost Formula: 3(B(R) + B(S)) = {manual_cost}\n")
+        out.append(f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n")
         if manual_cost != estimated_cost:
-            explanation += f"{indent}Difference Explanation: PostgreSQL's optimizer might choose this join for its efficiency in certain sorted datasets, a nuance not captured by the simple manual cost.\n"
-        return base_stats + explanation
+            out.append(f"{indent}Difference Explanation: PostgreSQL's optimizer might choose this join for its efficiency in certain sorted datasets, a nuance not captured by the simple manual cost.\n")
+
+class GenericInfoNode(ScanNodes):
+    # Nodes without a course formula: a fixed description filled in from the plan
+    __slots__ = ()
+    TEMPLATE = ""
+
+    def fetch_stats(self, depth, out):
+        super().fetch_stats(depth, out)
+        out.append(self.TEMPLATE.format(
+            indent=_indent(depth),
+            rows=self.node_json.get('Plan Rows', 0),
+            cost=self.node_json.get('Total Cost'),
+        ))
 
 @register_node('Hash') # No formula provided by course
-class HashNode(ScanNodes):
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
-        estimated_rows = self.node_json.get('Plan Rows', 0)
-        estimated_cost = self.node_json.get('Total Cost')
-        explanation = f"{indent}Hash operation involves approximately {estimated_rows} rows.\n"
-        explanation += f"{indent}Manual Cost Formula not available\n"
-        explanation += f"{indent}Estimated Cost by DBMS: {estimated_cost}\n"
-        #explanation += f"{indent}Difference Explanation: Actual hash costs in PostgreSQL also consider factors such as hash bucket density and memory availability.\n"
-        return base_stats + explanation
+class HashNode(GenericInfoNode):
+    __slots__ = ()
+    TEMPLATE = (
+        "{indent}Hash operation involves approximately {rows} rows.\n"
+        "{indent}Manual Cost Formula not available\n"
+        "{indent}Estimated Cost by DBMS: {cost}\n"
+        #"{indent}Difference Explanation: Actual hash costs in PostgreSQL also consider factors such as hash bucket density and memory availability.\n"
+    )
 
 @register_node('Hash Join') # done
 class HashJoinNode(ScanNodes):
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
-        left_child = self.node_json['Plans'][0]
-        right_child = self.node_json['Plans'][1]
+    __slots__ = ()
+
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
+        left_child, right_child = self.join_inputs()
         R_block_size = left_child.get('Plan Rows', 0)
         S_block_size = right_child.get('Plan Rows', 0)
         manual_cost = 3 * (R_block_size + S_block_size)
         estimated_cost = self.node_json.get('Total Cost')
-        explanation = f"{indent}Hash Join uses condition: {self.node_json.get('Hash Cond', 'No hash condition reported')}\n"
-        explanation += f"{indent}Manual Cost Formula: 3(B(R) + B(S)) = {manual_cost}\n"
-        explanation += f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n"
+        super().fetch_stats(depth, out)
+        out.append(f"{indent}Hash Join uses condition: {self.node_json.get('Hash Cond', 'No hash condition reported')}\n")
+        out.append(f"{indent}Manual Cost Formula: 3(B(R) + B(S)) = {manual_cost}\n")
+        out.append(f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n")
         if manual_cost != estimated_cost:
-            explanation += f"{indent}Difference Explanation: PostgreSQL may optimize hash joins with in-memory hash tables, which can significantly alter the real-world costs, not shown here.\n"
-        return base_stats + explanation
+            out.append(f"{indent}Difference Explanation: PostgreSQL may optimize hash joins with in-memory hash tables, which can significantly alter the real-world costs, not shown here.\n")
 
 @register_node('Gather')  # No formula provided by course
-@register_node('Gather')
-class GatherNode(ScanNodes):
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
-        estimated_cost = self.node_json.get('Total Cost')
-        explanation = f"{indent}Gather node combines the output of child nodes executed by parallel workers.\n"
-        explanation += f"{indent}Manual Cost Formula not available\n"
-        explanation += f"{indent}Estimated Cost by DBMS: {estimated_cost}\n"
-        return base_stats + explanation
+class GatherNode(GenericInfoNode):
+    __slots__ = ()
+    TEMPLATE = (
+        "{indent}Gather node combines the output of child nodes executed by parallel workers.\n"
+        "{indent}Manual Cost Formula not available\n"
+        "{indent}Estimated Cost by DBMS: {cost}\n"
+    )
 
 @register_node('Gather Merge')  # No formula provided by course
-class GatherMergeNode(ScanNodes):
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
-        estimated_cost = self.node_json.get('Total Cost')
-        explanation = f"{indent}Gather Merge combines sorted outputs of parallel workers preserving the order.\n"
-        explanation += f"{indent}Manual Cost Formula not available\n"
-        explanation += f"Estimated Cost by DBMS: {estimated_cost}\n"
-        #explanation += f"{indent}Difference Explanation: PostgreSQL uses a heap that at any instant holds the next tuple from each stream, which can affect performance depending on the size of streams.\n"
-        return base_stats + explanation
+class GatherMergeNode(GenericInfoNode):
+    __slots__ = ()
+    TEMPLATE = (
+        "{indent}Gather Merge combines sorted outputs of parallel workers preserving the order.\n"
+        "{indent}Manual Cost Formula not available\n"
+        "Estimated Cost by DBMS: {cost}\n"
+        #"{indent}Difference Explanation: PostgreSQL uses a heap that at any instant holds the next tuple from each stream, which can affect performance depending on the size of streams.\n"
+    )
 
 @register_node('Sort') # Done
 class SortNode(ScanNodes):
-    def fetch_stats(self, depth):
-        indent = '    ' * depth
-        base_stats = super().fetch_stats(depth)
+    __slots__ = ()
+
+    def fetch_stats(self, depth, out):
+        indent = _indent(depth)
         rel_name = self.node_json.get('Relation Name')
         if rel_name:
-            self.cursor.execute("SELECT relpages FROM pg_class WHERE relname = %s", (rel_name,))
-            result = self.cursor.fetchone()
+            result = self.fetch_relation_stats(rel_name)
             if result:
-                num_blocks = result[0]
+                num_blocks = result[1]
                 manual_cost = 3 * num_blocks
                 estimated_cost = self.node_json.get('Total Cost')
-                explanation = f"{indent}Sort on relation: {rel_name}.\n"
-                explanation += f"{indent}Manual Cost Formula: 3B = {manual_cost}\n"
-                explanation += f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n"
                 if manual_cost != estimated_cost:
-                    explanation += f"{indent}Difference Explanation: PostgreSQL may adjust costs based on work memory and actual data size which are not factored into manual calculations.\n"
-                    return base_stats + explanation
-        return f"{indent}Unable to retrieve block information for relation: {rel_name}\n" + base_stats
+                    super().fetch_stats(depth, out)
+                    out.append(f"{indent}Sort on relation: {rel_name}.\n")
+                    out.append(f"{indent}Manual Cost Formula: 3B = {manual_cost}\n")
+                    out.append(f"{indent}Calculated Cost: {manual_cost} (Estimated Cost by DBMS: {estimated_cost})\n")
+                    out.append(f"{indent}Difference Explanation: PostgreSQL may adjust costs based on work memory and actual data size which are not factored into manual calculations.\n")
+                    return
+        out.append(f"{indent}Unable to retrieve block information for relation: {rel_name}\n")
+        super().fetch_stats(depth, out)
 
 # Execution and explanation parsing
-def execute_explain(query, cursor):
-    cursor.execute(SQL("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {}").format(SQL(query)))
+# Longest an EXPLAIN ANALYZE may run before the server cancels it
+ANALYZE_STATEMENT_TIMEOUT_MS = 30000
+
+def execute_explain(query, cursor, analyze=False):
+    from psycopg2.sql import SQL
+    _register_json_loads()
+    # Plain EXPLAIN only plans the query; ANALYZE actually runs it, so it is opt-in
+    options = "ANALYZE, BUFFERS, " if analyze else ""
+    if analyze:
+        # Cap how long the query may run; SET LOCAL ends with the transaction when the connection is returned
+        cursor.execute("SET LOCAL statement_timeout = %s", (ANALYZE_STATEMENT_TIMEOUT_MS,))
+    cursor.execute(SQL("EXPLAIN ({}FORMAT JSON) {}").format(SQL(options), SQL(query)))
     return cursor.fetchone()[0]
 
-def parse_and_explain(qep_json, cursor):
-    def create_node(plan, cursor):
-        node_type = plan['Node Type']
-        return node_registry.get(node_type, Node)(plan, cursor)
-
-    root_node = create_node(qep_json['Plan'], cursor)
-    stack = [(root_node, qep_json['Plan'])]
+def prefetch_relation_stats(relation_names, cursor, stats_cache):
+    # One pg_class round-trip for every relation in the plan instead of one per node
+    rel_names = [name for name in relation_names if ('pg_class', name) not in stats_cache]
+    if not rel_names:
+        return
+    cursor.execute("EXECUTE relation_stats(%s)", (rel_names,))
+    stats_by_rel = {relname: (reltuples, relpages) for relname, reltuples, relpages in cursor.fetchall()}
+    for name in rel_names:
+        stats_cache[('pg_class', name)] = stats_by_rel.get(name)
+
+def prefetch_index_columns(index_scans, cursor, stats_cache):
+    # Same idea for the index -> column lookups made by index scans
+    index_names = {node.node_json['Index Name'] for node in index_scans if 'Index Name' in node.node_json}
+    index_names = [name for name in index_names if ('pg_index', name) not in stats_cache]
+    if not index_names:
+        return
+    cursor.execute("EXECUTE index_columns(%s)", (index_names,))
+    column_by_index = {}
+    for index_name, column_name in cursor.fetchall():
+        column_by_index.setdefault(index_name, column_name)
+    for name in index_names:
+        stats_cache[('pg_index', name)] = column_by_index.get(name)
+
+def prefetch_column_stats(filtered_relations, cursor, stats_cache):
+    # Selectivity and V(R, a) estimates need pg_stats for every filtered relation; load them in one query
+    table_names = [name for name in filtered_relations if ('pg_stats', name) not in stats_cache]
+    if not table_names:
+        return
+    cursor.execute("EXECUTE column_stats(%s)", (table_names,))
+    columns_by_table = {name: {} for name in table_names}
+    for row in cursor.fetchall():
+        columns_by_table[row[0]].setdefault(row[1], row[2:])
+    for name, columns in columns_by_table.items():
+        stats_cache[('pg_stats', name)] = columns
+
+def prefetch_primary_keys(filtered_relations, cursor, stats_cache):
+    # Single-column primary keys of the filtered relations, for the equality selectivity shortcut
+    table_names = [name for name in filtered_relations if ('pg_index_pk', name) not in stats_cache]
+    if not table_names:
+        return
+    cursor.execute("EXECUTE primary_keys(%s)", (table_names,))
+    pk_by_table = dict(cursor.fetchall())
+    for name in table_names:
+        stats_cache[('pg_index_pk', name)] = pk_by_table.get(name)
+
+def parse_and_explain(qep_json, cursor, stats_cache=None, with_stats=True):
+    if stats_cache is None:
+        stats_cache = {}
+
+    get_cls = node_registry.get  # bound once for the tree walk
+    root_plan = qep_json['Plan']
+    root_node = get_cls(root_plan['Node Type'], Node)(root_plan, cursor, stats_cache)
+
+    # Single pre-order walk: builds the tree, records each node's depth in output order,
+    # and collects what the catalog prefetch needs. Children are pushed in reverse so
+    # they pop left to right.
+    relation_names = set()
+    filtered_relations = set()
+    index_scans = []
+    ordered = []
+    stack = [(root_node, root_plan, 0)]
     while stack:
-        node, plan = stack.pop()
+        node, plan, depth = stack.pop()
+        ordered.append((node, depth))
+        # Only node classes with a cost formula read the catalog; Bitmap Heap Scan, Aggregate etc.
+        # fall back to the plain Node and need no stats
+        if 'Relation Name' in plan and isinstance(node, ScanNodes):
+            relation_names.add(plan['Relation Name'])
+            if 'Filter' in plan or 'Index Cond' in plan:
+                filtered_relations.add(plan['Relation Name'])
+        if isinstance(node, IndexScanNode):
+            index_scans.append(node)
         if 'Plans' in plan:
             for subplan in plan['Plans']:
-                child_node = create_node(subplan, cursor)
-                node.children.append(child_node)
-                stack.append((child_node, subplan))
-    return root_node.explain()
+                node.children.append(get_cls(subplan['Node Type'], Node)(subplan, cursor, stats_cache))
+            for child_node in reversed(node.children):
+                stack.append((child_node, child_node.node_json, depth + 1))
+
+    # with_stats=False renders only node types and costs, without touching the catalog
+    if with_stats:
+        prepare_catalog_statements(cursor)
+        prefetch_relation_stats(relation_names, cursor, stats_cache)
+        prefetch_index_columns(index_scans, cursor, stats_cache)
+        prefetch_column_stats(filtered_relations, cursor, stats_cache)
+        prefetch_primary_keys(filtered_relations, cursor, stats_cache)
+
+    parts = []
+    for node, depth in ordered:
+        indent = _indent(depth)
+        node_json = node.node_json
+        node_type = node_json.get('Node Type', 'Unknown')
+        startup_cost = node_json.get('Startup Cost')
+        total_cost = node_json.get('Total Cost')
+        parts.append(f"{indent}Node Type: {node_type}\n{indent}Estimated Cost: Startup {startup_cost},Total {total_cost}\n")
+        if with_stats:
+            node.fetch_stats(depth, parts)
+    return "".join(parts)
 
 def extract_node_data(plan):
     node_data = {
@@ -350,22 +652,89 @@ def convert_qep_to_graph_data(qep_json):
     graph_data = {'root': extract_node_data(root_node)}
     return graph_data
 
-def analyze_query(query, conn):
+# Finished analyses, most recent last, so repeating a query does not re-run EXPLAIN or the catalog lookups.
+# Entries are keyed on a snapshot of everything that can change a plan (see fetch_plan_epoch),
+# so new statistics, DDL or planner settings start a new entry.
+_MAX_CACHED_EXPLANATIONS = 128
+_explanation_cache = OrderedDict()
+_explanation_cache_lock = threading.Lock()
+
+# Literals, quoted identifiers and dollar-quoted bodies are matched as whole tokens and kept as they are;
+# any run of comments and whitespace outside them is replaced by one space
+_NORMALIZE_RE = re.compile(r"""
+    ( '(?:[^']|'')*'                              # string literal
+    | "(?:[^"]|"")*"                              # quoted identifier
+    | \$([A-Za-z_][A-Za-z_0-9]*|)\$[\s\S]*?\$\2\$   # dollar-quoted body, $$...$$ or $tag$...$tag$
+    )
+    | (?: --[^\n]*                                # line comment
+        | /\*[\s\S]*?\*/                            # block comment
+        | \s
+        )+
+""", re.VERBOSE)
+
+def normalize_query(query):
+    # Queries that differ only in layout or comments share a cache entry; literals are left untouched
+    return _NORMALIZE_RE.sub(lambda m: m.group(1) or ' ', query).strip().rstrip(';').strip()
+
+def fetch_plan_epoch(cursor):
+    # One cheap round-trip that changes whenever a cached plan could be stale:
+    # - the latest (auto)analyze and (auto)vacuum time, for new planner statistics; VACUUM updates
+    #   reltuples/relpages in place, which leaves the pg_class xmin below unchanged
+    # - row count and newest row version of pg_class/pg_index, for CREATE/DROP INDEX, ALTER TABLE etc.
+    #   (DDL inserts, deletes or rewrites these catalog rows)
+    # - the planner settings of this session (enable_*, cost constants, work_mem ...)
+    cursor.execute("""
+        SELECT
+            (SELECT greatest(max(last_analyze), max(last_autoanalyze),
+                             max(last_vacuum), max(last_autovacuum))::text FROM pg_stat_user_tables),
+            (SELECT count(*) || ':' || max(xmin::text::bigint) FROM pg_class),
+            (SELECT count(*) || ':' || max(xmin::text::bigint) FROM pg_index),
+            (SELECT md5(string_agg(name || '=' || setting, ',' ORDER BY name))
+             FROM pg_settings
+             WHERE category LIKE 'Query Tuning%' OR name = 'work_mem')
+    """)
+    return cursor.fetchone()
+
+def analyze_query(query, conn, analyze=False, with_stats=True, use_cache=None, refresh=False):
+    import psycopg2
+    # EXPLAIN ANALYZE runs the query, so its results are only cached when the caller asks for it.
+    # refresh=True skips the lookup but still stores the new result, for changes the epoch can't see
+    if use_cache is None:
+        use_cache = not analyze
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            qep = execute_explain(query, cur)
+        with conn.cursor() as cur:
+            if use_cache:
+                key = (conn.dsn, normalize_query(query), analyze, with_stats, fetch_plan_epoch(cur))
+                with _explanation_cache_lock:
+                    cached = None if refresh else _explanation_cache.get(key)
+                    if cached is not None:
+                        _explanation_cache.move_to_end(key)
+                        return cached
+            qep = execute_explain(query, cur, analyze)
             if qep:
-                explanation = "Query Plan Explanation:\n" + parse_and_explain(qep[0], cur)
+                # Catalog lookups are cached for this analysis only, so stats are never staler than one query
+                stats_cache = {}
+                explanation = "Query Plan Explanation:\n" + parse_and_explain(qep[0], cur, stats_cache, with_stats)
                 graph_data = convert_qep_to_graph_data(qep[0])  
-                return qep, explanation, graph_data
+                result = (qep, explanation, graph_data)
+                if use_cache:
+                    with _explanation_cache_lock:
+                        _explanation_cache[key] = result
+                        if len(_explanation_cache) > _MAX_CACHED_EXPLANATIONS:
+                            _explanation_cache.popitem(last=False)
+                return result
             else:
                 return None, "No QEP found for the given query.", None
             
     except psycopg2.DatabaseError as db_err:
+        _broken_conns.add(conn)
         return None, f"Database error: {db_err}", None
     except psycopg2.ProgrammingError as pg_err:
+        _broken_conns.add(conn)
         return None, f"Programming error: {pg_err}", None
     except Exception as e:
+        if isinstance(e, psycopg2.Error):
+            _broken_conns.add(conn)
         return None, f"An error occurred: {e}", None
 
 
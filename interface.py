@@ -5,9 +5,10 @@ from tkinter import messagebox, scrolledtext, Canvas
 
 
 class AppGUI:
-    def __init__(self, master, on_submit_callback):
+    def __init__(self, master, on_submit_callback, on_cancel_callback=None):
         self.master = master
         self.on_submit_callback = on_submit_callback
+        self.on_cancel_callback = on_cancel_callback
 
         master.title("QEP Cost Analysis Tool")
         master.geometry('1200x600')  # Adjust the size as necessary
@@ -30,9 +31,18 @@ class AppGUI:
         self.query_input = scrolledtext.ScrolledText(left_pane, undo=True, height=10)
         self.query_input.pack(fill=tk.BOTH, expand=True, padx=75, pady=5)
 
-        # Submit Button
-        self.submit_button = tk.Button(left_pane, text="Analyze Query", command=self.on_submit)
-        self.submit_button.pack(pady=5)
+        # Submit Buttons: plain EXPLAIN by default, EXPLAIN ANALYZE (runs the query) on request
+        button_frame = tk.Frame(left_pane)
+        button_frame.pack(pady=5)
+        self.submit_button = tk.Button(button_frame, text="Analyze Query", command=self.on_submit)
+        self.submit_button.pack(side='left', padx=5)
+        self.analyze_button = tk.Button(button_frame, text="Run with Stats", command=lambda: self.on_submit(analyze=True))
+        self.analyze_button.pack(side='left', padx=5)
+        self.bypass_cache = tk.BooleanVar(value=False)
+        self.bypass_cache_check = tk.Checkbutton(button_frame, text="Bypass cache", variable=self.bypass_cache)
+        self.bypass_cache_check.pack(side='left', padx=5)
+        self.cancel_button = tk.Button(button_frame, text="Cancel", command=self.on_cancel)
+        self.cancel_button.pack(side='left', padx=5)
 
         # Explanation Display Area
         self.label_explanation = tk.Label(left_pane, text="QEP Cost Analysis:")
@@ -65,53 +75,70 @@ class AppGUI:
       
         self.canvas.delete("all")
 
-        # Function to recursively draw nodes and edges
-        def draw_node(node, x, y, level_width, parent_coords=None):
+        node_width = 100
+        node_height = 50
+        padding = 20  # Space between nodes
+        vertical_spacing = 100  # Space between levels
 
-            node_width = 100
-            node_height = 50
-            padding = 20  # Space between nodes
-            vertical_spacing = 100  # Space between levels
-
-            # Calculate the leftmost x position for children
-            total_children_width = node_width * len(node.get('children', [])) + padding * (len(node.get('children', [])) - 1)
-            start_x = x - total_children_width / 2 + node_width / 2
-
-            # Draw the node rectangle
-            x1 = x - node_width / 2
-            y1 = y - node_height / 2
-            x2 = x + node_width / 2
-            y2 = y + node_height / 2
-            self.canvas.create_rectangle(x1, y1, x2, y2, fill="lightgray")
-            self.canvas.create_text(x, y, text=f"{node['type']}\nCost: {node['cost']}")
-
-            # If this node has a parent, draw an edge from the parent
-            if parent_coords:
-                self.canvas.create_line(parent_coords[0], parent_coords[1], x, y1, arrow=tk.LAST)
-
-
-            # Calculate positions for children and draw them
-            child_x = start_x
-            for child in node.get('children', []):
-                next_y = y + node_height / 2 + vertical_spacing
-                draw_node(child, child_x, next_y, 400, (x, y2))
-                child_x += node_width + padding  # Move to the next child's x position
-
-        # Start drawing from the root node
         root_node = qep_data.get('root')  # This assumes you have a 'root' in your QEP data
         if root_node:
-            draw_node(root_node, x=self.canvas.winfo_width() // 2, y=50, level_width=self.canvas.winfo_width())
+            # Layout pass (post-order): leaves take consecutive slots from left to right and
+            # each parent is centered over its children, so subtrees never overlap
+            positions = {}  # id(node) -> (x, y)
+            next_slot = [0]
+
+            def layout_node(node, depth):
+                children = node.get('children', [])
+                for child in children:
+                    layout_node(child, depth + 1)
+                if children:
+                    x = (positions[id(children[0])][0] + positions[id(children[-1])][0]) / 2
+                else:
+                    x = next_slot[0] * (node_width + padding)
+                    next_slot[0] += 1
+                positions[id(node)] = (x, depth * (node_height + vertical_spacing))
+
+            layout_node(root_node, 0)
+
+            # Drawing pass: one visit per node, with the root centered in the canvas
+            offset_x = self.canvas.winfo_width() // 2 - positions[id(root_node)][0]
+            offset_y = 50
+            stack = [(root_node, None)]
+            while stack:
+                node, parent_coords = stack.pop()
+                x, y = positions[id(node)]
+                x += offset_x
+                y += offset_y
+
+                # Draw the node rectangle
+                x1 = x - node_width / 2
+                y1 = y - node_height / 2
+                x2 = x + node_width / 2
+                y2 = y + node_height / 2
+                self.canvas.create_rectangle(x1, y1, x2, y2, fill="lightgray")
+                self.canvas.create_text(x, y, text=f"{node['type']}\nCost: {node['cost']}")
+
+                # If this node has a parent, draw an edge from the parent
+                if parent_coords:
+                    self.canvas.create_line(parent_coords[0], parent_coords[1], x, y1, arrow=tk.LAST)
+
+                for child in node.get('children', []):
+                    stack.append((child, (x, y2)))
 
         self.canvas.update_idletasks()  # Update the canvas to ensure all items are drawn
         self.canvas.config(scrollregion=self.canvas.bbox("all"))
 
-    def on_submit(self):
+    def on_submit(self, analyze=False):
         query = self.query_input.get("1.0", tk.END).strip()
         if query:
-            self.on_submit_callback(query)  # Call the callback, which updates the GUI directly
+            self.on_submit_callback(query, analyze, self.bypass_cache.get())  # Results are delivered back through display_explanation/draw_graph
         else:
             self.display_error("Please enter a SQL query.")
 
+    def on_cancel(self):
+        if self.on_cancel_callback:
+            self.on_cancel_callback()
+
     def display_error(self, message):
         messagebox.showerror("Error", message)
 
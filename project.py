@@ -1,21 +1,99 @@
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from interface import AppGUI
 from explain import DBConnection, analyze_query
 
-def on_query_submit(query):
+DB_PARAMS = ('TPC-H', 'postgres', 'password', 'localhost', "5432")
+
+# Analyses run off the Tk thread so the window keeps repainting while PostgreSQL works
+executor = ThreadPoolExecutor(max_workers=2)
+current_job = None  # (future, job info) of the latest submission
+running_jobs = {}  # future -> job info of every submission not finished yet
+closing = False
+
+def run_analysis(query, analyze, bypass_cache, job):
+    with DBConnection(*DB_PARAMS) as conn:
+        job['pid'] = conn.get_backend_pid()  # lets Cancel stop the query on the server
+        return analyze_query(query, conn, analyze=analyze, refresh=bypass_cache)
+
+def on_query_submit(query, analyze=False, bypass_cache=False):
+    global current_job
+    if current_job is not None:
+        # The previous result would be discarded anyway; free its worker and backend
+        try:
+            stop_job(*current_job)
+        except Exception as e:
+            app_gui.display_error(str(e))
+    job = {'pid': None}
+    future = executor.submit(run_analysis, query, analyze, bypass_cache, job)
+    current_job = (future, job)
+    running_jobs[future] = job
+    app_gui.display_explanation("Analyzing query...")
+    # Tk widgets may only be touched from the main thread, so hand the result back through after()
+    future.add_done_callback(schedule_delivery)
+
+def schedule_delivery(future):
+    running_jobs.pop(future, None)
+    if closing:
+        return
     try:
-        with DBConnection('TPC-H', 'postgres', 'password', 'localhost', "5432") as conn:
-            qep, explanation, graph_data = analyze_query(query, conn)
-            app_gui.display_explanation(explanation)
-            if graph_data:  # Check if graph_data is not None or empty
-                app_gui.draw_graph(graph_data)
+        root.after(0, deliver_result, future)
+    except (RuntimeError, tk.TclError):
+        pass  # The window was destroyed while the analysis was finishing
+
+def deliver_result(future):
+    if current_job is None or future is not current_job[0] or future.cancelled():
+        return  # Superseded by a newer submission or cancelled
+    try:
+        qep, explanation, graph_data = future.result()
+        app_gui.display_explanation(explanation)
+        if graph_data:  # Check if graph_data is not None or empty
+            app_gui.draw_graph(graph_data)
     except Exception as e: #error handling
         app_gui.display_error(str(e))
 
+def cancel_backend(pid):
+    with DBConnection(*DB_PARAMS) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_cancel_backend(%s)", (pid,))
+
+def stop_job(future, job):
+    # Returns True if the job never started; a running one is cancelled on the server,
+    # after which analyze_query reports the cancellation
+    if future.cancel():
+        return True
+    if not future.done() and job['pid'] is not None:
+        cancel_backend(job['pid'])
+    return False
+
+def on_cancel():
+    global current_job
+    if current_job is None:
+        return
+    try:
+        if stop_job(*current_job):
+            current_job = None
+            app_gui.display_explanation("Analysis cancelled.")
+    except Exception as e:
+        app_gui.display_error(str(e))
+
+def on_close():
+    # The interpreter joins worker threads at exit, so stop a running query instead of waiting it out
+    global closing
+    closing = True
+    for future, job in list(running_jobs.items()):
+        try:
+            stop_job(future, job)
+        except Exception:
+            pass  # Exiting anyway; the statement timeout still bounds the wait
+    executor.shutdown(wait=False, cancel_futures=True)
+    root.destroy()
+
 if __name__ == '__main__':
     # Initialize GUI
     root = tk.Tk()
-    app_gui = AppGUI(root, on_submit_callback=on_query_submit)
-    
+    app_gui = AppGUI(root, on_submit_callback=on_query_submit, on_cancel_callback=on_cancel)
+    root.protocol("WM_DELETE_WINDOW", on_close)
+
     # Run the app
     root.mainloop()